@@ -1,12 +1,14 @@
 import sys
 import argparse
-from . import generator
-from . import server
 
 VERSION = [0, 1]
 
 
 def main():
+    # import を遅らせて CLI の起動を軽くする
+    from . import generator
+    from . import server
+
     # setup
     parser = argparse.ArgumentParser(description='A static site generator')
     sub = parser.add_subparsers()
@@ -1,17 +1,194 @@
+import html
 import re
 import pathlib
 import datetime
-import toml
 import markdown2
+try:
+    import tomllib
+except ImportError:
+    # Python 3.11 より前は同じ parser の外部配布版を使う
+    import tomli as tomllib
+try:
+    # C 実装の parser があれば使う
+    import cmarkgfm
+    from cmarkgfm.cmark import Options as CmarkOptions
+    CMARK_OPTS = (CmarkOptions.CMARK_OPT_UNSAFE
+                  | CmarkOptions.CMARK_OPT_FOOTNOTES)
+except ImportError:
+    cmarkgfm = None
+try:
+    # linear-time DFA engine。URL regex の backtracking を避ける
+    import re2 as link_re
+except ImportError:
+    link_re = re
 
 SPLITTER = re.compile(r'^\+\+\+$', re.M)
-MD_TITLE_MATCH = re.compile(r'^\s*#\s*(.*?)\s*\n')
+# URL は ASCII 前提。unicode property の参照を省く
+_LINK_FLAGS = re.ASCII if link_re is re else 0
 LINK_PATTERN = [(
-    re.compile(
-        r'((([A-Za-z]{3,9}:(?:\/\/)?)(?:[\-;:&=\+\$,\w]+@)?[A-Za-z0-9\.\-]+(:[0-9]+)?|(?:www\.|[\-;:&=\+\$,\w]+@)[A-Za-z0-9\.\-]+)((?:\/[\+~%\/\.\w\-_]*)?\??(?:[\-\+=&;%@\.\w_]*)#?(?:[\.\!\/\\\w]*))?)'  # noqa: E501
-    ),
+    link_re.compile(
+        r'((([A-Za-z]{3,9}:(?:\/\/)?)(?:[\-;:&=\+\$,\w]+@)?[A-Za-z0-9\.\-]+(:[0-9]+)?|(?:www\.|[\-;:&=\+\$,\w]+@)[A-Za-z0-9\.\-]+)((?:\/[\+~%\/\.\w\-_]*)?\??(?:[\-\+=&;%@\.\w_]*)#?(?:[\.\!\/\\\w]*))?)',  # noqa: E501
+        _LINK_FLAGS),
     r'\1')]
-TITLE_MATCH = re.compile(r'^\s+<li><a href="[^"]*">([^<]*)')
+TOC_DEDENT = re.compile(r'(?m)^  ')
+TOC_DEPTH = 4
+MD_EXTRAS = {
+    'fenced-code-blocks': None,
+    'header-ids': None,
+    'toc': {
+        'depth': TOC_DEPTH
+    },
+    'link-patterns': None,
+    'tables': None,
+    'footnotes': None,
+}
+# extras の登録と regex の準備を一度だけ払う。
+# convert() は先頭で reset() するので使い回せる
+_MD = markdown2.Markdown(extras=MD_EXTRAS, link_patterns=LINK_PATTERN)
+_MD_NO_LINKS = markdown2.Markdown(
+    extras={k: v
+            for k, v in MD_EXTRAS.items() if k != 'link-patterns'})
+
+
+def _convert_markdown2(body: str):
+    # URL らしき文字列がない文書は link-patterns の scan ごと省く
+    if '://' in body or 'www.' in body or '@' in body:
+        md = _MD
+    else:
+        md = _MD_NO_LINKS
+    converted = md.convert(body)
+    # parser が集めた (level, id, name) をそのまま返す
+    return converted, md._toc or []
+
+
+HEADING_MATCH = re.compile(r'<h([1-6])>(.*?)</h\1>', re.S)
+TAG_STRIP = re.compile(r'<[^>]*>')
+NON_ID_CHARS = re.compile(r'[^-_a-z0-9]')
+CODE_BLOCK = re.compile(r'<pre lang="([^"]+)"><code>(.*?)</code></pre>', re.S)
+
+
+def _split_frontmatter(raw: bytes):
+    '''
+    +++ で囲まれた frontmatter を切り出す。
+    fence の走査は bytes のまま行なって、切り出した部分だけ decode する
+    '''
+    if raw.startswith(b'+++\n'):
+        # bytes.find is a C-level scan over the prefix only,
+        # much cheaper than running the regex over the whole file
+        end = raw.find(b'\n+++\n', 3)
+        if end != -1:
+            return (tomllib.loads(raw[4:end].decode('utf-8')),
+                    raw[end + 5:].decode('utf-8'))
+    elif raw.startswith(b'+++\r\n'):
+        # 3 始まりで opening fence を閉じる \r も拾う (空 frontmatter)
+        end = raw.find(b'\r\n+++\r\n', 3)
+        if end != -1:
+            return (tomllib.loads(raw[5:end].decode('utf-8')),
+                    raw[end + 7:].decode('utf-8'))
+    # fence が先頭以外にある edge case は regex に fallback する。
+    # read_text() 相当の universal newline に揃えてから split する
+    src = raw.decode('utf-8').replace('\r\n', '\n')
+    splitted = SPLITTER.split(src, 2)
+    if len(splitted) == 3:
+        return tomllib.loads(splitted[1]), splitted[2]
+    return {}, src
+
+
+def _md_title(body: str):
+    '''
+    先頭の '# ...' 行から title を取り出す。regex を使わない
+    '''
+    head = body.lstrip()
+    if not head.startswith('#'):
+        return None
+    nl = head.find('\n')
+    if nl == -1:
+        return None
+    return head[1:nl].strip()
+
+
+def _slugify(text: str, used: dict) -> str:
+    '''
+    markdown2 の header-ids と同じ形式の id を作る
+    '''
+    slug = NON_ID_CHARS.sub('', text.strip().lower().replace(' ', '-'))
+    count = used.get(slug)
+    if count is None:
+        used[slug] = 0
+        return slug
+    used[slug] = count + 1
+    return f'{slug}-{count + 1}'
+
+
+def _toc_from_headings(headings) -> str:
+    '''
+    (depth, id, text) のリストから nested <ul> を組み立てる
+    '''
+    if not headings:
+        return ''
+    out = []
+    depth = 0
+    for rel, hid, text in headings:
+        if rel > depth:
+            out.append('<ul>\n' * (rel - depth))
+            depth = rel
+        else:
+            out.append('</li>\n')
+            while depth > rel:
+                out.append('</ul></li>\n')
+                depth -= 1
+        out.append(f'<li><a href="#{hid}">{text}</a>')
+    out.append('</li>\n')
+    while depth > 1:
+        out.append('</ul></li>\n')
+        depth -= 1
+    out.append('</ul>')
+    return ''.join(out)
+
+
+def _highlight_code(m) -> str:
+    from pygments import highlight
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+    try:
+        lexer = get_lexer_by_name(m.group(1))
+    except ClassNotFound:
+        return m.group(0)
+    return highlight(html.unescape(m.group(2)), lexer,
+                     HtmlFormatter(cssclass='codehilite'))
+
+
+def _convert_cmark(body: str):
+    '''
+    cmark で変換して、markdown2 が出していた
+    header-id, toc, codehilite を後処理で補う
+    '''
+    converted = cmarkgfm.github_flavored_markdown_to_html(body, CMARK_OPTS)
+
+    title = ''
+    headings = []
+    used: dict = {}
+
+    def _add_id(m):
+        nonlocal title
+        level = int(m.group(1))
+        inner = m.group(2)
+        text = TAG_STRIP.sub('', inner)
+        hid = _slugify(text, used)
+        if level == 1:
+            if not title:
+                title = text
+        elif level <= TOC_DEPTH:
+            headings.append((level - 1, hid, text))
+        return f'<h{level} id="{hid}">{inner}</h{level}>'
+
+    converted = HEADING_MATCH.sub(_add_id, converted)
+    converted = CODE_BLOCK.sub(_highlight_code, converted)
+    if not title and headings:
+        # h1 がないときは最初の heading を title にする
+        title = headings[0][2]
+    return converted, _toc_from_headings(headings), title
 
 
 class Article:
@@ -23,56 +200,97 @@ class Article:
         self.datetime = None
         self.date = None
         self.content = ''
+        self.toc = ''
         self.tags = []
 
-    def load(self, convert_md=True) -> None:
+    def load(self, convert_md=True, cache=None) -> None:
         '''
         convert markdown to html
         '''
-        src = self.md_path.read_text(encoding='utf-8')
-        splitted = SPLITTER.split(src, 2)
-        if len(splitted) == 3:
-            frontmatter = toml.loads(splitted[1])
-            body = splitted[2]
-        else:
-            frontmatter = {}
-            body = src
+        if convert_md and cache and self.load_cached(cache):
+            return
+        stat = self.md_path.stat() if cache else None
+
+        # read_bytes skips the TextIOWrapper layer; decode happens
+        # after the frontmatter split, on the slices that need it
+        frontmatter, body = _split_frontmatter(self.md_path.read_bytes())
         self.datetime = frontmatter.get('date')
         if not self.datetime:
             self.datetime = datetime.datetime(2000,
                                               1,
                                               1,
                                               tzinfo=datetime.timezone.utc)
+        elif not isinstance(self.datetime, datetime.datetime):
+            # date だけの frontmatter も datetime に揃える。
+            # cache 復元 (fromisoformat) と型が揃わないと sort できない
+            self.datetime = datetime.datetime(self.datetime.year,
+                                              self.datetime.month,
+                                              self.datetime.day,
+                                              tzinfo=datetime.timezone.utc)
+        tzinfo = getattr(self.datetime, 'tzinfo', None)
+        if tzinfo is not None and type(tzinfo) is not datetime.timezone:
+            # toml の TomlTz は picklable ではないので置き換える
+            self.datetime = self.datetime.replace(tzinfo=datetime.timezone(
+                tzinfo.utcoffset(self.datetime)))
         self.date = self.datetime.strftime('%Y-%m-%d')
         self.tags = frontmatter.get('tags', [])
 
-        self.title = ''
-        m = MD_TITLE_MATCH.match(body)
-        if m:
-            self.title = m.group(1).strip()
-
-        if convert_md:
-            extras = {
-                'fenced-code-blocks': None,
-                'header-ids': None,
-                'toc': {
-                    'depth': 4
-                },
-                'link-patterns': None,
-                'tables': None,
-                'footnotes': None,
-            }
-            md = markdown2.Markdown(extras=extras, link_patterns=LINK_PATTERN)
-            self.content = md.convert(body)
-
-            # tocのtoplevelを削除する
-            splitted = self.content.toc_html.strip().split('\n')
-            self.toc = '\n'.join([x[2:] for x in splitted[2:-1]])
-
-            m = TITLE_MATCH.match(splitted[1])
-
-            if m:
-                self.title = m.group(1)
+        # title は変換結果から取れたときだけ markdown の走査を省く
+        if convert_md and cmarkgfm:
+            self.content, self.toc, title = _convert_cmark(body)
+            self.title = title or _md_title(body) or ''
+
+            if cache:
+                cache.put(self.md_path, stat, self._to_entry())
+        elif convert_md:
+            self.content, toc_entries = _convert_markdown2(body)
+
+            # tocのtoplevelを削除する。
+            # 行 list を作らず index の slice で済ます
+            toc_html = self.content.toc_html.strip()
+            first = toc_html.find('\n')
+            second = toc_html.find('\n', first + 1)
+            last = toc_html.rfind('\n')
+            self.toc = TOC_DEDENT.sub('', toc_html[second + 1:last])
+
+            if toc_entries:
+                # 先頭 heading の text を parser の toc list から取る
+                self.title = TAG_STRIP.sub('', toc_entries[0][2]).strip()
+            else:
+                self.title = _md_title(body) or ''
+
+            if cache:
+                cache.put(self.md_path, stat, self._to_entry())
+        else:
+            self.title = _md_title(body) or ''
+
+    def load_cached(self, cache) -> bool:
+        '''
+        try to restore from the build cache. return True on a hit.
+        '''
+        stat = self.md_path.stat()
+        entry = cache.get(self.md_path, stat)
+        if not entry:
+            return False
+        self._from_entry(entry)
+        return True
+
+    def _to_entry(self) -> dict:
+        return {
+            'title': self.title,
+            'date': self.datetime.isoformat(),
+            'tags': self.tags,
+            'content': str(self.content),
+            'toc': self.toc,
+        }
+
+    def _from_entry(self, entry: dict) -> None:
+        self.title = entry['title']
+        self.datetime = datetime.datetime.fromisoformat(entry['date'])
+        self.date = self.datetime.strftime('%Y-%m-%d')
+        self.tags = entry['tags']
+        self.content = entry['content']
+        self.toc = entry['toc']
 
     def __str__(self) -> str:
         return f'<{self.title}>'
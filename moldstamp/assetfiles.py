@@ -1,48 +1,103 @@
+import concurrent.futures
+import os
 import pathlib
-from typing import List, Set, Optional
+from operator import attrgetter
+from typing import Dict, List, Optional
 from .article import Article
 
+# 小さいサイトではワーカーの起動コストの方が高くつく
+MIN_ARTICLES_FOR_POOL = 4
+
+
+def _load_article(article: Article) -> Article:
+    '''
+    ProcessPoolExecutor worker. must be module-level to be picklable.
+    '''
+    try:
+        article.load()
+    except AttributeError as e:
+        print(e)
+    return article
+
 
 class AssetFiles:
     def __init__(self) -> None:
-        self.used: Set[str] = set()
         self.articles: List[Article] = []
         self.assets: List[pathlib.Path] = []
+        self._by_name: Dict[str, Article] = {}
+        self._sorted = False
 
     def traverse(self, path: pathlib.Path) -> None:
         if path.name[0] == '.':
             return
 
         if path.is_dir():
-            for child in path.iterdir():
-                self.traverse(child)
-        elif path.suffix == '.md':
-            article_name = path.stem
+            self._scan(os.fspath(path))
+        else:
+            self._add_file(path.name, path)
+
+    def _scan(self, dir_path: str) -> None:
+        # 再帰しないで stack で回す
+        stack = [dir_path]
+        while stack:
+            # DirEntry caches the file type from the directory scan,
+            # so no stat() per entry
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.name[0] == '.':
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        self._add_file(entry.name, pathlib.Path(entry.path))
+
+    def _add_file(self, name: str, path: pathlib.Path) -> None:
+        if name.endswith('.md'):
+            article_name = name[:-3]
 
             # unique name
-            if article_name in self.used:
+            if article_name in self._by_name:
                 raise RuntimeError('used name: ' + article_name)
-            self.used.add(article_name)
 
-            self.articles.append(Article(path))
+            article = Article(path)
+            self._by_name[article_name] = article
+            self.articles.append(article)
+            self._sorted = False
 
         else:
             # copy assets
             self.assets.append(path)
 
-    def load(self, convert_md=True) -> None:
-        for a in self.articles:
+    def load(self, convert_md=True, cache=None) -> None:
+        pending = self.articles
+        if convert_md and cache:
+            pending = [a for a in self.articles if not a.load_cached(cache)]
+
+        if convert_md and len(pending) > MIN_ARTICLES_FOR_POOL:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=os.cpu_count()) as executor:
+                loaded = executor.map(_load_article, pending, chunksize=4)
+                # reassign the results from the worker processes
+                for a, result in zip(pending, loaded):
+                    a.__dict__.update(result.__dict__)
+            if cache:
+                for a in pending:
+                    if a.content:
+                        cache.put(a.md_path, a.md_path.stat(), a._to_entry())
+            return
+
+        for a in pending:
             try:
-                a.load(convert_md)
+                a.load(convert_md, cache)
             except AttributeError as e:
                 print(e)
 
     def sort(self) -> None:
-        self.articles = sorted(self.articles,
-                               reverse=True,
-                               key=lambda x: x.datetime)
+        if self._sorted:
+            return
+        # attrgetter は C-level で attribute を引く
+        self.articles.sort(key=attrgetter('datetime'), reverse=True)
+        self._sorted = True
 
     def get_article(self, name: str) -> Optional[Article]:
-        for a in self.articles:
-            if a.name == name:
-                return a
+        return self._by_name.get(name)
@@ -0,0 +1,53 @@
+import hashlib
+import json
+import pathlib
+from typing import Optional
+
+CACHE_NAME = '.moldstamp-cache.json'
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class BuildCache:
+    '''
+    変換結果のキャッシュ。
+    mtime と size が変わっていない記事は markdown 変換をスキップする。
+    '''
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+
+    @staticmethod
+    def load(dst: pathlib.Path) -> 'BuildCache':
+        cache = BuildCache(dst / CACHE_NAME)
+        try:
+            cache.entries = json.loads(cache.path.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            cache.entries = {}
+        return cache
+
+    def get(self, md_path: pathlib.Path, stat) -> Optional[dict]:
+        entry = self.entries.get(str(md_path))
+        if not entry:
+            return None
+        if (entry['mtime_ns'] != stat.st_mtime_ns
+                or entry['size'] != stat.st_size):
+            return None
+        return entry
+
+    def put(self, md_path: pathlib.Path, stat, entry: dict) -> None:
+        entry['mtime_ns'] = stat.st_mtime_ns
+        entry['size'] = stat.st_size
+        self.entries[str(md_path)] = entry
+        self.dirty = True
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        with self.path.open('w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        self.dirty = False
@@ -1,8 +1,66 @@
+import concurrent.futures
 import pathlib
 import shutil
-import jinja2
-from pygments.formatters import HtmlFormatter
-from .assetfiles import AssetFiles
+
+# sendfile が使えないとき用の userland buffer を広げておく
+shutil.COPY_BUFSIZE = 1024 * 1024
+
+# pygments の version と style が同じなら不変
+_CSS_CACHE: dict = {}
+
+
+def _get_css(style='default', prefix='.codehilite') -> str:
+    key = (style, prefix)
+    css = _CSS_CACHE.get(key)
+    if css is None:
+        from pygments.formatters import HtmlFormatter
+        css = HtmlFormatter(style=style).get_style_defs(prefix)
+        _CSS_CACHE[key] = css
+    return css
+
+
+TEMPLATE_ZIP = '.compiled_templates.zip'
+
+
+def _create_env(template_dir: pathlib.Path, dst: pathlib.Path):
+    '''
+    AOT compile した template の zip を使い回す。
+    template が更新されていたら compile し直す
+    '''
+    import jinja2
+
+    target = dst / TEMPLATE_ZIP
+    try:
+        zip_mtime = target.stat().st_mtime_ns
+        stale = any(f.stat().st_mtime_ns >= zip_mtime
+                    for f in template_dir.iterdir())
+    except OSError:
+        stale = True
+    if stale:
+        source_env = jinja2.Environment(loader=jinja2.FileSystemLoader(
+            str(template_dir)),
+                                        auto_reload=False)
+        source_env.compile_templates(str(target),
+                                     zip='deflated',
+                                     ignore_errors=False,
+                                     log_function=lambda msg: None)
+    # ModuleLoader は parse/compile を一切やらない
+    return jinja2.Environment(loader=jinja2.ModuleLoader(str(target)))
+
+
+def _write_if_changed(path: pathlib.Path, text: str) -> bool:
+    '''
+    中身が同じなら書き込まない。書いたら True
+    '''
+    # 先に encode して比較も書き込みも bytes 一発で済ます
+    data = text.encode('utf-8')
+    try:
+        if path.read_bytes() == data:
+            return False
+    except OSError:
+        pass
+    path.write_bytes(data)
+    return True
 
 
 def setup_parser(parser):
@@ -19,12 +77,18 @@ Target folder to write index.html.
 First, remove target and recreate that.
 Then, generate articles into the folder.
 ''')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='ignore the build cache and convert everything')
 
 
 def execute(args) -> None:
     '''
     ソースフォルダから目標フォルダにファイルを変換しながら移し替える
     '''
+    from .assetfiles import AssetFiles
+    from .cache import CACHE_NAME, BuildCache
+
     src = pathlib.Path(args.src).resolve()
     dst = pathlib.Path(args.dst).resolve()
 
@@ -32,50 +96,87 @@ def execute(args) -> None:
 
     print(f'{src} =>\n {dst}')
 
+    cache = None
+    if not getattr(args, 'force', False):
+        cache = BuildCache.load(dst)
+
     asset_files = AssetFiles()
     asset_files.traverse(src / 'articles')
-    asset_files.load()
+    asset_files.load(cache=cache)
     asset_files.sort()
 
-    if dst.exists():
-        # clear
-        for child in dst.iterdir():
-            if child.is_dir():
-                shutil.rmtree(child, True)
-            else:
-                child.unlink()
-    else:
-        dst.mkdir(0o777, True, True)
+    dst.mkdir(0o777, True, True)
+
+    # 全消しはしない。出力されなくなったファイルだけ消す
+    expected = {'index.html', css_path.name, CACHE_NAME, TEMPLATE_ZIP}
+    expected.update(f'{a.name}.html' for a in asset_files.articles)
+    expected.update(asset.name for asset in asset_files.assets)
+    for child in dst.iterdir():
+        if child.name in expected:
+            continue
+        if child.is_dir():
+            shutil.rmtree(child, True)
+        else:
+            child.unlink()
 
     template_dir = src / 'templates'
+    env = _create_env(template_dir, dst)
+
+    css_name = css_path.name
 
     # create index
     index_path = dst / 'index.html'
-    index_template = jinja2.Template(
-        (template_dir / 'index.html').read_text(encoding='utf-8'))
-    with index_path.open('w', encoding='utf-8') as f:
-        rendered = index_template.render(css_path=css_path.name,
-                                         articles=asset_files.articles)
-        f.write(rendered)
+    index_template = env.get_template('index.html')
+    _write_if_changed(
+        index_path,
+        index_template.render(css_path=css_name,
+                              articles=asset_files.articles))
 
     # write articles
-    article_template = jinja2.Template(
-        (template_dir / 'article.html').read_text(encoding='utf-8'))
-    for a in asset_files.articles:
-        write_path = dst / f'{a.name}.html'
-        write_path.parent.mkdir(0o777, True, True)
-        print(f'{write_path.relative_to(dst)}: {a}')
-        with write_path.open('w', encoding='utf-8') as f:
-            rendered = article_template.render(css_path=css_path.name, a=a)
-            f.write(rendered)
+    article_template = env.get_template('article.html')
+
+    def write_article(a):
+        # 出力は flat なので parent は dst。mkdir 済み
+        name_html = f'{a.name}.html'
+        _write_if_changed(dst / name_html,
+                          article_template.render(css_path=css_name, a=a))
+        return name_html
+
+    # render は compile 済み template なので thread-safe。
+    # write は GIL を手放す
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {
+            executor.submit(write_article, a): a
+            for a in asset_files.articles
+        }
+        for future in concurrent.futures.as_completed(futures):
+            print(f'{future.result()}: {futures[future]}')
 
     # generate css
-    with css_path.open('w', encoding='utf-8') as f:
-        f.write(HtmlFormatter(style='default').get_style_defs('.codehilite'))
-    print(css_path.relative_to(dst))
+    _write_if_changed(css_path, _get_css())
+    print(css_name)
 
     # copy assets
-    for asset in asset_files.assets:
-        target = dst / asset.name
-        print(target.relative_to(dst))
-        shutil.copyfile(src / asset, target)
+    def copy_asset(asset):
+        source = src / asset
+        name = asset.name
+        target = dst / name
+        try:
+            src_stat = source.stat()
+            dst_stat = target.stat()
+            if (dst_stat.st_mtime_ns >= src_stat.st_mtime_ns
+                    and dst_stat.st_size == src_stat.st_size):
+                # already up to date
+                return name
+        except OSError:
+            pass
+        # shutil.copyfile copies in-kernel via sendfile on Linux
+        shutil.copyfile(source, target)
+        return name
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        for name in executor.map(copy_asset, asset_files.assets):
+            print(name)
+
+    if cache:
+        cache.save()
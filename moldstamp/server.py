@@ -1,6 +1,4 @@
 import pathlib
-import jinja2
-from .assetfiles import AssetFiles
 
 
 def setup_parser(parser):
@@ -22,6 +20,8 @@ def execute(args) -> None:
     '''
     launch http server with livereloading
     '''
+    import jinja2
+    from .assetfiles import AssetFiles
     # port = args.port
     src = pathlib.Path(args.src).resolve()
 
@@ -35,21 +35,71 @@ def execute(args) -> None:
     template_dir = src / 'templates'
     css_path = 'default.css'
 
+    # compile templates once and cache them. auto_reload picks up
+    # template edits without recompiling on every request.
+    # bytecode cache で process をまたいでも compile を省く
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(
+        str(template_dir)),
+                             auto_reload=True,
+                             bytecode_cache=jinja2.FileSystemBytecodeCache())
+
+    # traverse は起動時に一度だけ。
+    # 変更は livereload の watcher が invalidate する
+    state = {'asset_files': None}
+
+    def get_asset_files() -> AssetFiles:
+        asset_files = state['asset_files']
+        if asset_files is None:
+            asset_files = AssetFiles()
+            asset_files.traverse(src / 'articles')
+            asset_files.load(convert_md=False)
+            asset_files.sort()
+            state['asset_files'] = asset_files
+        return asset_files
+
+    def invalidate():
+        state['asset_files'] = None
+
+    def stream_template(template, error_prefix, **context):
+        '''
+        chunk 渡しのまま、render 中の例外を inline の message で返す
+        '''
+        stream = template.stream(**context)
+        stream.enable_buffering(16)
+
+        def chunks():
+            try:
+                yield from stream
+            except Exception as e:
+                yield f'{error_prefix} => {e}'
+
+        return chunks()
+
+    # 変換済み記事は mtime が変わるまで使い回す
+    article_cache = {}
+
+    def load_article(a):
+        mtime = a.md_path.stat().st_mtime_ns
+        cached = article_cache.get(a.md_path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        a.load()
+        article_cache[a.md_path] = (mtime, a)
+        return a
+
     @app.route('/index.html')
     def index():
-        asset_files = AssetFiles()
-        asset_files.traverse(src / 'articles')
-        asset_files.load(convert_md=False)
-        asset_files.sort()
-        index_template = jinja2.Template(
-            (template_dir / 'index.html').read_text(encoding='utf-8'))
-        return index_template.render(css_path=css_path,
-                                     articles=asset_files.articles)
+        asset_files = get_asset_files()
+        index_template = env.get_template('index.html')
+        # bottle は iterable をそのまま chunk で送れる
+        return stream_template(index_template,
+                               'index.html',
+                               css_path=css_path,
+                               articles=asset_files.articles)
 
     @app.route('/<article>')
     def article(article):
-        asset_files = AssetFiles()
-        asset_files.traverse(src / 'articles')
+        asset_files = get_asset_files()
 
         name = pathlib.Path(article).stem
 
@@ -58,12 +108,14 @@ def execute(args) -> None:
             return f'{name} not found'
 
         try:
-            a.load()
+            a = load_article(a)
 
-            article_template = jinja2.Template(
-                (template_dir / 'article.html').read_text(encoding='utf-8'))
+            article_template = env.get_template('article.html')
 
-            return article_template.render(css_path=css_path, a=a)
+            return stream_template(article_template,
+                                   article,
+                                   css_path=css_path,
+                                   a=a)
         except Exception as e:
             return f'{article} => {e}'
 
@@ -71,11 +123,11 @@ def execute(args) -> None:
     server = Server(app)
 
     # server.watch
-    def watch(target: src):
+    def watch(target: src, func=None):
         print(f'watch: {target}')
-        server.watch(target)
+        server.watch(target, func)
 
-    watch(f'{src}/')
+    watch(f'{src}/', invalidate)
 
     # start
     server.serve(root='./index.html')